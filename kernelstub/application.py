@@ -41,22 +41,22 @@ terms.
 
 import logging, os
 
-systemd_support = False
-try:
-    from systemd.journal import JournalHandler
-    systemd_support = True
-
-except ImportError:
-    pass
-
 import logging.handlers as handlers
 
-from . import drive as Drive
-from . import nvram as Nvram
-from . import opsys as Opsys
-from . import installer as Installer
 from . import config as Config
-from . import kernel_option as KernelOption
+
+# Console log level for each -v
+log_levels = (logging.WARNING, logging.INFO, logging.DEBUG)
+
+# Settings main() can't run without
+required_keys = (
+    'kernel_options', 'esp_path', 'setup_loader', 'manage_mode', 'force_update')
+
+log = logging.getLogger('kernelstub')
+stream_fmt = logging.Formatter(
+    '%(name)-21s: %(levelname)-8s %(message)s')
+file_fmt = logging.Formatter(
+    '%(asctime)s - %(name)-21s: %(levelname)-8s %(message)s')
 
 class CmdLineError(Exception):
     pass
@@ -64,25 +64,38 @@ class CmdLineError(Exception):
 class Kernelstub():
 
     def parse_options(self, options):
-        for index, option in enumerate(options):
-            if '"' in option:
-                matched = False
-                itr = 1
-                while matched == False:
-                    try:
-                        next_option = options[index + itr]
-                        option = '%s %s' % (option, next_option)
-                        options[index + itr] = ""
-                        if '"' in next_option:
-                            matched = True
-                        else:
-                            itr = itr + 1
-                    except IndexError:
-                        matched = True
-            options[index] = option
-        return options
+        # Split an option string on spaces, keeping quoted values together
+        return Config.option_re.findall(options)
 
-    def main(self, args): # Do the thing
+    def scan_dir(self, path):
+        # One getdents pass instead of a stat per candidate file
+        try:
+            with os.scandir(path) as entries:
+                return {entry.name: entry for entry in entries}
+        except OSError:
+            return {}
+
+    def file_exists(self, path, dir_path, dir_entries):
+        if os.path.dirname(path) == dir_path:
+            entry = dir_entries.get(os.path.basename(path))
+            return entry is not None and entry.is_file()
+        return os.path.isfile(path)
+
+    def add_log_handler(self, log, handler, fmt, level):
+        handler.setFormatter(fmt)
+        handler.setLevel(level)
+        log.addHandler(handler)
+
+    def mktable(self, data, padding):
+        return ''.join(
+            '    {:.<{pad}}{}\n'.format(key, value, pad=padding)
+            for key, value in data.items())
+
+    def setup_logging(self, args):
+        # Handlers are attached to the shared logger, so only do it once per
+        # process. Running main() again would otherwise log everything twice.
+        if log.handlers:
+            return
 
         log_file_path = '/var/log/kernelstub.log'
         if args.log_file:
@@ -90,49 +103,40 @@ class Kernelstub():
 
         verbosity = 0
         if args.verbosity:
-            verbosity = args.verbosity
-        if verbosity > 2:
-            verbosity = 2
+            verbosity = min(args.verbosity, 2)
 
         if args.print_config:
             verbosity = 1
 
-        level = {
-            0 : logging.WARNING,
-            1 : logging.INFO,
-            2 : logging.DEBUG,
-        }
-
-        console_level = level[verbosity]
-        file_level = level[2]
+        console_level = log_levels[verbosity]
+        file_level = logging.DEBUG
 
-        stream_fmt = logging.Formatter(
-            '%(name)-21s: %(levelname)-8s %(message)s')
-        file_fmt = logging.Formatter(
-            '%(asctime)s - %(name)-21s: %(levelname)-8s %(message)s')
-        log = logging.getLogger('kernelstub')
+        self.add_log_handler(
+            log, logging.StreamHandler(), stream_fmt, console_level)
 
-        console_log = logging.StreamHandler()
-        console_log.setFormatter(stream_fmt)
-        console_log.setLevel(console_level)
+        # --print-config doesn't change anything, so don't touch the log file
+        if not args.print_config:
+            file_log = handlers.RotatingFileHandler(
+                log_file_path, maxBytes=(1048576*5), backupCount=5, delay=True)
+            self.add_log_handler(log, file_log, file_fmt, file_level)
 
-        file_log = handlers.RotatingFileHandler(
-            log_file_path, maxBytes=(1048576*5), backupCount=5)
-        file_log.setFormatter(file_fmt)
-        file_log.setLevel(file_level)
-
-        log.addHandler(console_log)
-        log.addHandler(file_log)
+        # Only pull in journald support when we're actually setting up logs
+        try:
+            from systemd.journal import JournalHandler
+            systemd_support = True
+        except ImportError:
+            systemd_support = False
 
         if systemd_support:
-            journald_log = JournalHandler()
-            journald_log.setLevel(file_level)
-            journald_log.setFormatter(stream_fmt)
-            log.addHandler(journald_log)
+            self.add_log_handler(log, JournalHandler(), stream_fmt, file_level)
 
         log.setLevel(logging.DEBUG)
 
-        log.debug('Got command line options: %s' % args)
+    def main(self, args): # Do the thing
+
+        self.setup_logging(args)
+
+        log.debug('Got command line options: %s', args)
 
         # Figure out runtime options
         no_run = False
@@ -163,66 +167,9 @@ class Kernelstub():
         if args.root_path:
             root_path = args.root_path
 
-        boot_path = os.path.join(root_path, 'boot')
-        latest_option, previous_option = KernelOption.latest_option(boot_path)
-
-        opsys = Opsys.OS()
-
-        if args.kernel_path:
-            log.debug(
-                'Manually specified kernel path:\n ' +
-                '               %s' % args.kernel_path)
-            opsys.kernel_path = args.kernel_path
-        elif latest_option:
-            opsys.kernel_path = latest_option['kernel']
-        else:
-            opsys.kernel_path = os.path.join(boot_path, opsys.kernel_name)
-            if not os.path.exists(opsys.kernel_path):
-                opsys.kernel_path = os.path.join(root_path, opsys.kernel_name)
-
-        if args.initrd_path:
-            log.debug(
-                'Manually specified initrd path:\n ' +
-                '               %s' % args.initrd_path)
-            opsys.initrd_path = args.initrd_path
-        elif latest_option:
-            opsys.initrd_path = latest_option['initrd']
-        else:
-            opsys.initrd_path = os.path.join(boot_path, opsys.initrd_name)
-            if not os.path.exists(opsys.initrd_path):
-                opsys.initrd_path = os.path.join(root_path, opsys.initrd_name)
-
-        if previous_option:
-            opsys.old_kernel_path = previous_option['kernel']
-            opsys.old_initrd_path = previous_option['initrd']
-        else:
-            # We use the default location in / before overwriting to /boot/
-            # Then we can use the existing fallbacks in installer.
-            if not os.path.exists(opsys.old_kernel_path):
-                opsys.old_kernel_path = os.path.join(
-                    boot_path, opsys.old_kernel_name
-                )
-
-            if not os.path.exists(opsys.old_initrd_path):
-                opsys.old_initrd_path = os.path.join(
-                    boot_path, opsys.old_initrd_name
-                )
-
-        if not os.path.exists(opsys.kernel_path):
-            log.exception('Can\'t find the kernel image \'' + opsys.kernel_path + '\'! \n\n'
-                         'Please use the --kernel-path option to specify '
-                         'the path to the kernel image')
-            exit(0)
-
-        if not os.path.exists(opsys.initrd_path):
-            log.exception('Can\'t find the initrd image \'' + opsys.initrd_path + '\'! \n\n'
-                         'Please use the --initrd-path option to specify '
-                         'the path to the initrd image')
-            exit(0)
-
         # Check for kernel parameters. Without them, stop and fail
         if args.k_options:
-            configuration['kernel_options'] = self.parse_options(args.k_options.split())
+            configuration['kernel_options'] = self.parse_options(args.k_options)
         else:
             try:
                 configuration['kernel_options']
@@ -236,7 +183,7 @@ class Kernelstub():
                 raise CmdLineError("No Kernel Parameters found")
                 exit(168)
 
-        log.debug(config.print_config())
+        log.debug('%s', config)
 
         if args.setup_loader:
             configuration['setup_loader'] = True
@@ -250,80 +197,144 @@ class Kernelstub():
 
 
         log.debug('Checking configuration integrity...')
-        try:
-            kernel_opts = configuration['kernel_options']
-            esp_path = configuration['esp_path']
-            setup_loader = configuration['setup_loader']
-            manage_mode = configuration['manage_mode']
-            force = configuration['force_update']
-
-        except KeyError:
-            log.exception(
+        missing = [key for key in required_keys if key not in configuration]
+        if missing:
+            log.error(
                 'Malformed configuration! \n'
                 'The configuration we got is bad, and we can\'nt continue. '
                 'Please check the config files and make sure they are correct. '
                 'If you can\'t figure it out, then deleting them should fix '
                 'the errors and cause kernelstub to regenerate them from '
-                'Default. \n\n You can use "-vv" to get the configuration used.')
-            log.debug('Configuration we got: \n\n%s' % config.print_config())
+                'Default. \n\n Missing settings: %s'
+                '\n\n You can use "-vv" to get the configuration used.',
+                ', '.join(missing))
+            log.debug('Configuration we got: \n\n%s', config)
             exit(169)
 
+        kernel_opts, esp_path, setup_loader, manage_mode, force = (
+            configuration[key] for key in required_keys)
+
 
         if args.add_options:
-            add_opts = args.add_options.split(" ")
-            add_opts = config.parse_options(add_opts)
-            for opt in add_opts:
-                if opt not in kernel_opts:
-                    kernel_opts.append(opt)
-                    configuration['kernel_options'] = kernel_opts
+            add_opts = config.parse_options(args.add_options)
+            # dict.fromkeys() is an insertion-ordered set
+            kernel_opts = list(dict.fromkeys(kernel_opts + add_opts))
 
         if args.remove_options:
-            rem_opts = args.remove_options.split(" ")
-            rem_opts = config.parse_options(rem_opts)
-            kernel_opts = list(set(kernel_opts) - set(rem_opts))
-            configuration['kernel_options'] = kernel_opts
+            rem_opts = frozenset(config.parse_options(args.remove_options))
+            kernel_opts = [opt for opt in kernel_opts if opt not in rem_opts]
+
+        kernel_opts_line = " ".join(kernel_opts)
 
         if args.force_update:
             force = True
-        if configuration['force_update'] == True:
-            force = True
+
+        if args.print_config:
+            all_config = self.mktable({
+                'Kernel Options:'               : kernel_opts_line,
+                'ESP Location:'                 : esp_path,
+                'Management Mode:'              : manage_mode,
+                'Install Loader configuration:' : setup_loader,
+                'Configuration version:'        : configuration['config_rev'],
+            }, 31)
+            log.info('Configuration details: \n\n%s', all_config)
+            return 0
+
+        # These pull in debian.changelog and subprocess/shutil, and poke at
+        # sysfs and NVRAM, so only load them once we're going to set up boot.
+        from . import opsys as Opsys
+        from . import kernel_option as KernelOption
+        from . import drive as Drive
+        from . import nvram as Nvram
+        from . import installer as Installer
+
+        boot_path = os.path.join(root_path, 'boot')
+        # List /boot once, for both the versioned images and the fallbacks
+        boot_files = self.scan_dir(boot_path)
+        latest_option, previous_option = KernelOption.latest_option(
+            boot_path, boot_files)
+
+        opsys = Opsys.get_os()
+
+        if args.kernel_path:
+            log.debug(
+                'Manually specified kernel path:\n '
+                '               %s', args.kernel_path)
+            opsys.kernel_path = args.kernel_path
+        elif latest_option:
+            opsys.kernel_path = latest_option['kernel']
+        else:
+            opsys.kernel_path = os.path.join(boot_path, opsys.kernel_name)
+            if not self.file_exists(opsys.kernel_path, boot_path, boot_files):
+                opsys.kernel_path = os.path.join(root_path, opsys.kernel_name)
+
+        if args.initrd_path:
+            log.debug(
+                'Manually specified initrd path:\n '
+                '               %s', args.initrd_path)
+            opsys.initrd_path = args.initrd_path
+        elif latest_option:
+            opsys.initrd_path = latest_option['initrd']
+        else:
+            opsys.initrd_path = os.path.join(boot_path, opsys.initrd_name)
+            if not self.file_exists(opsys.initrd_path, boot_path, boot_files):
+                opsys.initrd_path = os.path.join(root_path, opsys.initrd_name)
+
+        if previous_option:
+            opsys.old_kernel_path = previous_option['kernel']
+            opsys.old_initrd_path = previous_option['initrd']
+        else:
+            # We use the default location in / before overwriting to /boot/
+            # Then we can use the existing fallbacks in installer.
+            if not os.path.exists(opsys.old_kernel_path):
+                opsys.old_kernel_path = os.path.join(
+                    boot_path, opsys.old_kernel_name
+                )
+
+            if not os.path.exists(opsys.old_initrd_path):
+                opsys.old_initrd_path = os.path.join(
+                    boot_path, opsys.old_initrd_name
+                )
+
+        if not self.file_exists(opsys.kernel_path, boot_path, boot_files):
+            log.error('Can\'t find the kernel image \'' + opsys.kernel_path + '\'! \n\n'
+                      'Please use the --kernel-path option to specify '
+                      'the path to the kernel image')
+            exit(0)
+
+        if not self.file_exists(opsys.initrd_path, boot_path, boot_files):
+            log.error('Can\'t find the initrd image \'' + opsys.initrd_path + '\'! \n\n'
+                      'Please use the --initrd-path option to specify '
+                      'the path to the initrd image')
+            exit(0)
 
         log.debug('Structing objects')
 
-        drive = Drive.Drive(root_path=root_path, esp_path=esp_path)
+        drive = Drive.get_drive(root_path=root_path, esp_path=esp_path)
         nvram = Nvram.NVRAM(opsys.name, opsys.version)
         installer = Installer.Installer(nvram, opsys, drive)
 
         # Log some helpful information, to file and optionally console
-        info = (
-            '    OS:..................%s %s\n' %(opsys.name_pretty,opsys.version) +
-            '    Root partition:......%s\n'    % drive.root_fs +
-            '    Root FS UUID:........%s\n'    % drive.root_uuid +
-            '    ESP Path:............%s\n'    % esp_path +
-            '    ESP Partition:.......%s\n'    % drive.esp_fs +
-            '    ESP Partition #:.....%s\n'    % drive.esp_num +
-            '    NVRAM entry #:.......%s\n'    % nvram.os_entry_index +
-            '    Boot Variable #:.....%s\n'    % nvram.order_num +
-            '    Kernel Boot Options:.%s\n'    % " ".join(kernel_opts) +
-            '    Kernel Image Path:...%s\n'    % opsys.kernel_path +
-            '    Initrd Image Path:...%s\n'    % opsys.initrd_path +
-            '    Force-overwrite:.....%s\n'    % str(force))
-
-        log.info('System information: \n\n%s' % info)
-
-        if args.print_config:
-            all_config = (
-                '   ESP Location:..................%s\n' % configuration['esp_path'] +
-                '   Management Mode:...............%s\n' % configuration['manage_mode'] +
-                '   Install Loader configuration:..%s\n' % configuration['setup_loader'] +
-                '   Configuration version:.........%s\n' % configuration['config_rev'])
-            log.info('Configuration details: \n\n%s' % all_config)
-            exit(0)
+        info = self.mktable({
+            'OS:'                  : '%s %s' % (opsys.name_pretty, opsys.version),
+            'Root partition:'      : drive.root_fs,
+            'Root FS UUID:'        : drive.root_uuid,
+            'ESP Path:'            : esp_path,
+            'ESP Partition:'       : drive.esp_fs,
+            'ESP Partition #:'     : drive.esp_num,
+            'NVRAM entry #:'       : nvram.os_entry_index,
+            'Boot Variable #:'     : nvram.order_num,
+            'Kernel Boot Options:' : kernel_opts_line,
+            'Kernel Image Path:'   : opsys.kernel_path,
+            'Initrd Image Path:'   : opsys.initrd_path,
+            'Force-overwrite:'     : force,
+        }, 21)
+        log.info('System information: \n\n%s', info)
 
         log.debug('Setting up boot...')
 
-        kopts = 'root=UUID=%s ro %s' % (drive.root_uuid, " ".join(kernel_opts))
-        log.debug('kopts: %s' % kopts)
+        kopts = 'root=UUID=%s ro %s' % (drive.root_uuid, kernel_opts_line)
+        log.debug('kopts: %s', kopts)
 
 
 
@@ -350,6 +361,7 @@ class Kernelstub():
 
         log.debug('Saving configuration to file')
 
+        configuration.update(kernel_options=kernel_opts)
         config.config['user'] = configuration
         config.save_config()
 
@@ -22,7 +22,38 @@ Please see the provided LICENSE.txt file for additional distribution/copyright
 terms.
 """
 
-import json, os, logging
+import os, logging, copy, re, stat
+
+# orjson parses and serializes a good deal faster, but it's optional. Both
+# branches work on UTF-8 bytes with non-ASCII text left unescaped, so the
+# file comes out the same either way.
+try:
+    import orjson
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(data):
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+except ImportError:
+    import json
+
+    def loads(data):
+        return json.loads(data.decode('UTF-8'))
+
+    def dumps(data):
+        return json.dumps(
+            data, indent=2, ensure_ascii=False).encode('UTF-8')
+
+# One kernel option: a run of non-space characters, where a quoted section
+# may contain spaces, e.g. foo="a b". An unterminated quote runs to the end.
+option_re = re.compile(r'(?:[^\s"]|"[^"]*(?:"|$))+')
+
+# The last parse of each configuration file, as {path: (signature, config)}.
+# The signature is the file's (mtime, size, inode), so repeated Config()
+# constructions in one process don't re-parse an unchanged file. The inode
+# catches a file that was replaced rather than rewritten.
+config_cache = {}
 
 class ConfigError(Exception):
     pass
@@ -48,52 +79,52 @@ class Config():
         self.log.debug('loaded kernelstub.Config')
         self.config_path = path
         self.config = self.load_config()
-        os.makedirs('/etc/kernelstub/', exist_ok=True)
 
     def load_config(self):
         self.log.info('Looking for configuration...')
 
-        if os.path.exists(self.config_path):
-            self.log.debug('Checking %s' % self.config_path)
+        try:
+            self.log.debug('Checking %s', self.config_path)
 
-            with open(self.config_path) as config_file:
-                self.config = json.load(config_file)
+            self.config = self.read_config(self.config_path)
 
-        elif os.path.exists('/etc/default/kernelstub'):
-            self.log.debug('Checking fallback /etc/default/kernelstub')
+        except FileNotFoundError:
+            try:
+                self.log.debug('Checking fallback /etc/default/kernelstub')
 
-            with open('/etc/default/kernelstub', mode='r') as config_file:
-                self.config = json.load(config_file)
+                self.config = self.read_config('/etc/default/kernelstub')
 
-        else:
-            self.log.info('No configuration file found, loading defaults.')
-            self.config = self.config_default
+            except FileNotFoundError:
+                self.log.info('No configuration file found, loading defaults.')
+                self.config = copy.deepcopy(self.config_default)
 
         self.log.debug('Configuration found!')
         try:
             user_config = self.config['user']
             self.log.debug(user_config)
         except KeyError:
-            self.config['user'] = self.config['default'].copy()
+            self.config['user'] = copy.deepcopy(self.config['default'])
 
+        user_config = self.config['user']
+        current_rev = self.config_default['default']['config_rev']
         try:
-            self.log.debug('Configuration version: %s' % self.config['user']['config_rev'])
-            if self.config['user']['config_rev'] < self.config_default['default']['config_rev']:
+            self.log.debug('Configuration version: %s', user_config['config_rev'])
+            if user_config['config_rev'] < current_rev:
                 self.log.warning("Updating old configuration.")
                 self.config = self.update_config(self.config)
                 self.log.info("Configuration updated successfully!")
-            elif self.config['user']['config_rev'] == self.config_default['default']['config_rev']:
+            elif user_config['config_rev'] == current_rev:
                 self.log.debug("Configuration up to date")
                 # Double-checking in case OEMs do bad things with the config file
-                if type(self.config['user']['kernel_options']) is str:
+                kernel_options = user_config['kernel_options']
+                if type(kernel_options) is str:
                     self.log.warning('Invalid kernel_options format!\n\n'
                                      'Usually outdated or buggy maintainer packages from your hardware OEM. '
                                      'Contact your hardware vendor to inform them to fix their packages.')
                     try:
-                        self.config['user']['kernel_options'] = self.parse_options(self.config['user']['kernel_options'].split())
+                        user_config['kernel_options'] = self.parse_options(kernel_options)
                     except:
                         raise ConfigError('Malformed configuration file found!')
-                        exit(169)
             else:
                 raise ConfigError("Configuration cannot be understood!")
         except KeyError:
@@ -102,48 +133,81 @@ class Config():
             self.log.info("Configuration updated successfully!")
         return self.config
 
+    def read_config(self, path):
+        with open(path, mode='rb') as config_file:
+            file_stat = os.fstat(config_file.fileno())
+            signature = (
+                file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+            cached = config_cache.get(path)
+            if cached and cached[0] == signature:
+                self.log.debug('Using cached configuration for %s', path)
+                config = cached[1]
+            else:
+                config = loads(config_file.read())
+                config_cache[path] = (signature, config)
+        return copy.deepcopy(config)
+
     def save_config(self, path='/etc/kernelstub/configuration'):
-        self.log.debug('Saving configuration to %s' % path)
+        self.log.debug('Saving configuration to %s', path)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write a new file and move it into place, so that an interrupted
+        # save can't leave a truncated configuration behind.
+        tmp_path = '%s.tmp' % path
+        try:
+            with open(tmp_path, mode='wb') as config_file:
+                self.copy_owner(path, config_file.fileno())
+                config_file.write(dumps(self.config))
+                config_file.flush()
+                os.fsync(config_file.fileno())
+                file_stat = os.fstat(config_file.fileno())
+            os.replace(tmp_path, path)
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        # The rename keeps the inode and mtime, so the next read of this
+        # path can use what we just wrote instead of parsing it again.
+        signature = (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+        config_cache[path] = (signature, copy.deepcopy(self.config))
 
-        with open(path, mode='w') as config_file:
-            json.dump(self.config, config_file, indent=2)
-        
         self.log.debug('Configuration saved!')
         return 0
 
+    def copy_owner(self, path, fd):
+        # Give the replacement the mode and owner of the file it replaces
+        try:
+            old_stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        os.fchmod(fd, stat.S_IMODE(old_stat.st_mode))
+        new_stat = os.fstat(fd)
+        if (new_stat.st_uid, new_stat.st_gid) != (old_stat.st_uid, old_stat.st_gid):
+            os.fchown(fd, old_stat.st_uid, old_stat.st_gid)
+
     def update_config(self, config):
         if config['user']['config_rev'] < 2:
             config['user']['live_mode'] = False
             config['default']['live_mode'] = False
         if config['user']['config_rev'] < 3:
             if type(config['user']['kernel_options']) is str:
-                config['user']['kernel_options'] = self.parse_options(config['user']['kernel_options'].split())
+                config['user']['kernel_options'] = self.parse_options(config['user']['kernel_options'])
             if type(config['default']['kernel_options']) is str:
-                config['default']['kernel_options'] = self.parse_options(config['default']['kernel_options'].split())
+                config['default']['kernel_options'] = self.parse_options(config['default']['kernel_options'])
         config['user']['config_rev'] = 3
         config['default']['config_rev'] = 3
         return config
 
     def parse_options(self, options):
+        # Split an option string on spaces, keeping quoted values together
         self.log.debug(options)
-        for index, option in enumerate(options):
-            if '"' in option:
-                matched = False
-                itr = 1
-                while matched == False:
-                    try:
-                        next_option = options[index + itr]
-                        option = '%s %s' % (option, next_option)
-                        options[index + itr] = ""
-                        if '"' in next_option:
-                            matched = True
-                        else:
-                            itr = itr + 1
-                    except IndexError:
-                        matched = True
-            options[index] = option
-        return options
+        return option_re.findall(options)
 
     def print_config(self):
-        output_config = json.dumps(self.config, indent=2)
-        return output_config
+        return dumps(self.config).decode('UTF-8')
+
+    def __str__(self):
+        return self.print_config()
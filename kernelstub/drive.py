@@ -22,7 +22,38 @@ Please see the provided LICENSE.txt file for additional distribution/copyright
 terms.
 """
 
-import os, logging, subprocess
+import os, logging
+
+# Drive objects, keyed on the paths they were probed for and the mount table
+# they were probed against.
+drive_cache = {}
+
+def get_drive(root_path="/", esp_path="/boot/efi"):
+    # /proc/mounts has no meaningful mtime, so key on its contents instead.
+    with open('/proc/mounts', mode='r') as proc_mounts:
+        mounts = proc_mounts.read()
+    key = (root_path, esp_path, mounts)
+    if key not in drive_cache:
+        drive_cache[key] = Drive(
+            root_path=root_path, esp_path=esp_path, mounts=mounts)
+    return drive_cache[key]
+
+# /dev/disk/by-uuid as {device name: UUID}, keyed on the directory's inode and
+# mtime. udev adds and removes links there, which bumps the mtime.
+uuid_cache = {}
+
+def get_uuids():
+    stat = os.stat('/dev/disk/by-uuid')
+    key = (stat.st_ino, stat.st_mtime_ns)
+    if key not in uuid_cache:
+        uuids = {}
+        with os.scandir('/dev/disk/by-uuid') as entries:
+            for entry in entries:
+                device = os.path.basename(os.readlink(entry.path))
+                uuids.setdefault(device, entry.name)
+        uuid_cache.clear()
+        uuid_cache[key] = uuids
+    return uuid_cache[key]
 
 class NoBlockDevError(Exception):
     pass
@@ -40,23 +71,23 @@ class Drive():
     esp_path = '/boot/efi'
     esp_num = 0
 
-    def __init__(self, root_path="/", esp_path="/boot/efi"):
+    def __init__(self, root_path="/", esp_path="/boot/efi", mounts=None):
         self.log = logging.getLogger('kernelstub.Drive')
         self.log.debug('loaded kernelstub.Drive')
 
         self.esp_path = esp_path
         self.root_path = root_path
-        self.log.debug('root path = %s' % self.root_path)
-        self.log.debug('esp_path = %s' % self.esp_path)
+        self.log.debug('root path = %s', self.root_path)
+        self.log.debug('esp_path = %s', self.esp_path)
 
-        self.mtab = self.get_drives()
+        self.mtab = self.get_drives(mounts)
 
         try:
             self.root_fs = self.get_part_dev(self.root_path)
             self.esp_fs = self.get_part_dev(self.esp_path)
             self.drive_name = self.get_drive_dev(self.esp_fs)
             self.esp_num = self.esp_fs[-1]
-            self.root_uuid = self.get_uuid(self.root_path)
+            self.root_uuid = self.get_uuid(self.root_fs)
         except NoBlockDevError as e:
             self.log.exception('Could not find a block device for the a ' +
                                'partition. This is a critical error and we ' +
@@ -70,28 +101,37 @@ class Drive():
             exit(177)
 
 
-        self.log.debug('Root is on /dev/%s' % self.drive_name)
-        self.log.debug('root_fs = %s ' % self.root_fs)
-        self.log.debug('root_uuid is %s' % self.root_uuid)
+        self.log.debug('Root is on /dev/%s', self.drive_name)
+        self.log.debug('root_fs = %s ', self.root_fs)
+        self.log.debug('root_uuid is %s', self.root_uuid)
 
 
-    def get_drives(self):
+    def get_drives(self, mounts=None):
         self.log.debug('Getting a list of drives')
-        with open('/proc/mounts', mode='r') as proc_mounts:
-            mtab = proc_mounts.readlines()
+        # get_drive() hands us the /proc/mounts it already read
+        if mounts is None:
+            with open('/proc/mounts', mode='r') as proc_mounts:
+                mounts = proc_mounts.read()
+
+        # Map each mount point to its device. Keep the first entry for a
+        # mount point, as the old linear search did.
+        mtab = {}
+        for mount in mounts.splitlines():
+            drive = mount.split(" ")
+            mtab.setdefault(drive[1], drive[0])
 
         self.log.debug(mtab)
         return mtab
 
     def get_part_dev(self, path):
-        self.log.debug('Getting the block device file for %s' % path)
-        for mount in self.mtab:
-            drive = mount.split(" ")
-            if drive[1] == path:
-                part_dev = os.path.realpath(drive[0])
-                self.log.debug('%s is on %s' % (path, part_dev))
-                return part_dev
-        raise NoBlockDevError('Couldn\'t find the block device for %s' % path)
+        self.log.debug('Getting the block device file for %s', path)
+        try:
+            part_dev = os.path.realpath(self.mtab[path])
+        except KeyError:
+            raise NoBlockDevError(
+                'Couldn\'t find the block device for %s' % path) from None
+        self.log.debug('%s is on %s', path, part_dev)
+        return part_dev
 
     def get_drive_dev(self, esp):
         # Ported from bash, out of @jackpot51's firmware updater
@@ -99,17 +139,17 @@ class Drive():
         efi_sys = os.readlink('/sys/class/block/%s' % efi_name)
         disk_sys = os.path.dirname(efi_sys)
         disk_name = os.path.basename(disk_sys)
-        self.log.debug('ESP is a partition on /dev/%s' % disk_name)
+        self.log.debug('ESP is a partition on /dev/%s', disk_name)
         return disk_name
 
-    def get_uuid(self, path):
-        self.log.debug('Looking for UUID for path %s' % path)
+    def get_uuid(self, fs):
+        self.log.debug('Looking for UUID for filesystem %s', fs)
         try:
-            args = ['findmnt', '-n', '-o', 'UUID', '--mountpoint', path]
-            result = subprocess.run(args, stdout=subprocess.PIPE)
-            uuid = result.stdout.decode('ASCII')
-            uuid = uuid.strip()
-            return uuid
+            uuids = get_uuids()
         except OSError as e:
             raise UUIDNotFoundError from e
-
+        try:
+            return uuids[os.path.basename(fs)]
+        except KeyError:
+            raise UUIDNotFoundError(
+                'Couldn\'t find the UUID for %s' % fs) from None
@@ -24,6 +24,7 @@ terms.
 
 import os, shutil, logging, platform, gzip
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 class FileOpsError(Exception):
@@ -50,13 +51,21 @@ class Installer():
         self.entry_dir = os.path.join(self.loader_dir, "entries")
         self.os_dir_name = "%s-%s" % (self.opsys.name, self.drive.root_uuid)
         self.os_folder = os.path.join(self.work_dir, self.os_dir_name)
-        self.kernel_dest = os.path.join(self.os_folder, self.opsys.kernel_name)
+        self.kernel_dest = os.path.join(
+            self.os_folder,
+            "%s.efi" % self.opsys.kernel_name)
         self.initrd_dest = os.path.join(self.os_folder, self.opsys.initrd_name)
 
-        if not os.path.exists(self.loader_dir):
-            os.makedirs(self.loader_dir)
-        if not os.path.exists(self.entry_dir):
-            os.makedirs(self.entry_dir)
+        # Where the loader entries find the images, relative to the ESP
+        efi_folder = '/EFI/%s' % self.os_dir_name
+        self.linux_line = '%s/%s.efi' % (efi_folder, self.opsys.kernel_name)
+        self.initrd_line = '%s/%s' % (efi_folder, self.opsys.initrd_name)
+        self.old_linux_line = '%s/%s-previous.efi' % (efi_folder,
+                                                      self.opsys.kernel_name)
+        self.old_initrd_line = '%s/%s-previous' % (efi_folder,
+                                                   self.opsys.initrd_name)
+
+        os.makedirs(self.entry_dir, exist_ok=True)
 
 
     def backup_old(self, kernel_opts, setup_loader=False, simulate=False):
@@ -70,24 +79,32 @@ class Installer():
 
         old_kernel_name = "%s-previous.efi" % self.opsys.kernel_name
         old_kernel_dest = os.path.join(self.os_folder, old_kernel_name)
-        try:
-            self.copy_files(
+        old_initrd_name = "%s-previous" % self.opsys.initrd_name
+        old_initrd_dest = os.path.join(self.os_folder, old_initrd_name)
+
+        # Same as in setup_kernel, the two copies can overlap.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            kernel_copy = executor.submit(
+                self.copy_files,
                 self.opsys.old_kernel_path,
                 old_kernel_dest,
                 simulate=simulate)
+            initrd_copy = executor.submit(
+                self.copy_files,
+                self.opsys.old_initrd_path,
+                old_initrd_dest,
+                simulate=simulate)
+
+        try:
+            kernel_copy.result()
         except:
             self.log.debug('Couldn\'t back up old kernel. There\'s ' +
                            'probably only one kernel installed.')
             self.old_kernel = False
             pass
 
-        old_initrd_name = "%s-previous" % self.opsys.initrd_name
-        old_initrd_dest = os.path.join(self.os_folder, old_initrd_name)
         try:
-            self.copy_files(
-                self.opsys.old_initrd_path,
-                old_initrd_dest,
-                simulate=simulate)
+            initrd_copy.result()
         except:
             self.log.debug('Couldn\'t back up old initrd.img. There\'s ' +
                            'probably only one kernel installed.')
@@ -96,41 +113,50 @@ class Installer():
 
         if setup_loader and self.old_kernel:
             self.ensure_dir(self.entry_dir)
-            linux_line = '/EFI/%s-%s/%s-previous.efi' % (self.opsys.name,
-                                                         self.drive.root_uuid,
-                                                         self.opsys.kernel_name)
-            initrd_line = '/EFI/%s-%s/%s-previous' % (self.opsys.name,
-                                                      self.drive.root_uuid,
-                                                      self.opsys.initrd_name)
             self.make_loader_entry(
                 self.opsys.name_pretty,
-                linux_line,
-                initrd_line,
+                self.old_linux_line,
+                self.old_initrd_line,
                 kernel_opts,
                 os.path.join(self.entry_dir, '%s-oldkern' % self.opsys.name))
 
     def setup_kernel(self, kernel_opts, setup_loader=False, overwrite=False, simulate=False):
-        self.log.info('Copying Kernel into ESP')
-        self.kernel_dest = os.path.join(
-            self.os_folder,
-            "%s.efi" % self.opsys.kernel_name)
+        self.log.info('Copying Kernel and initrd.img into ESP')
         self.ensure_dir(self.os_folder, simulate=simulate)
         self.log.debug('kernel being copied to %s' % self.kernel_dest)
+        self.log.debug('initrd being copied to %s' % self.initrd_dest)
 
-        try:
-            arch = platform.machine()
-            if arch == "arm64" or arch == "aarch64":
-                self.gunzip_files(
-                    self.opsys.kernel_path,
-                    self.kernel_dest,
-                    simulate=simulate)
-            else:
-                self.copy_files(
-                    self.opsys.kernel_path,
-                    self.kernel_dest,
-                    simulate=simulate)
+        arch = platform.machine()
+        if arch == "arm64" or arch == "aarch64":
+            copy_kernel = self.gunzip_files
+        else:
+            copy_kernel = self.copy_files
 
+        # The two images are independent, so overlap their I/O. They go to
+        # temporary names first and are only moved into place once both have
+        # been copied, so a failure can't leave a mismatched pair on the ESP.
+        kernel_tmp = self.kernel_dest
+        initrd_tmp = self.initrd_dest
+        if not simulate:
+            kernel_tmp = '%s.tmp' % self.kernel_dest
+            initrd_tmp = '%s.tmp' % self.initrd_dest
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            kernel_copy = executor.submit(
+                copy_kernel,
+                self.opsys.kernel_path,
+                kernel_tmp,
+                simulate=simulate)
+            initrd_copy = executor.submit(
+                self.copy_files,
+                self.opsys.initrd_path,
+                initrd_tmp,
+                simulate=simulate)
+
+        try:
+            kernel_copy.result()
         except FileOpsError as e:
+            self.remove_files(kernel_tmp, initrd_tmp)
             self.log.exception(
                 'Couldn\'t copy the kernel onto the ESP!\n' +
                 'This is a critical error and we cannot continue. Check your ' +
@@ -139,15 +165,10 @@ class Installer():
             self.log.debug(e)
             exit(170)
 
-        self.log.info('Copying initrd.img into ESP')
-        self.initrd_dest = os.path.join(self.os_folder, self.opsys.initrd_name)
         try:
-            self.copy_files(
-                self.opsys.initrd_path,
-                self.initrd_dest,
-                simulate=simulate)
-
+            initrd_copy.result()
         except FileOpsError as e:
+            self.remove_files(kernel_tmp, initrd_tmp)
             self.log.exception('Couldn\'t copy the initrd onto the ESP!\n' +
                                'This is a critical error and we cannot ' +
                                'continue. Check your settings to see if ' +
@@ -156,34 +177,30 @@ class Installer():
             self.log.debug(e)
             exit(171)
 
+        if not simulate:
+            os.replace(kernel_tmp, self.kernel_dest)
+            os.replace(initrd_tmp, self.initrd_dest)
         self.log.debug('Copy complete')
 
         if setup_loader:
             self.log.info('Setting up loader.conf configuration')
-            linux_line = '/EFI/%s-%s/%s.efi' % (self.opsys.name,
-                                                self.drive.root_uuid,
-                                                self.opsys.kernel_name)
-            initrd_line = '/EFI/%s-%s/%s' % (self.opsys.name,
-                                             self.drive.root_uuid,
-                                             self.opsys.initrd_name)
             if simulate:
                 self.log.info("Simulate creation of entry...")
                 self.log.info('Loader entry: %s/%s-current\n' %(self.entry_dir,
                                                                 self.opsys.name) +
                               'title %s\n' % self.opsys.name_pretty +
-                              'linux %s\n' % linux_line +
-                              'initrd %s\n' % initrd_line +
+                              'linux %s\n' % self.linux_line +
+                              'initrd %s\n' % self.initrd_line +
                               'options %s\n' % kernel_opts)
                 return 0
 
-            if not overwrite:
-                if not os.path.exists('%s/loader.conf' % self.loader_dir):
-                    overwrite = True
+            loader_conf = '%s/loader.conf' % self.loader_dir
+            if not overwrite and not os.path.exists(loader_conf):
+                overwrite = True
 
             if overwrite:
                 self.ensure_dir(self.loader_dir)
-                with open(
-                    '%s/loader.conf' % self.loader_dir, mode='w') as loader:
+                with open(loader_conf, mode='w') as loader:
 
                     default_line = 'default %s-current\n' % self.opsys.name
                     loader.write(default_line)
@@ -191,8 +208,8 @@ class Installer():
             self.ensure_dir(self.entry_dir)
             self.make_loader_entry(
                 self.opsys.name_pretty,
-                linux_line,
-                initrd_line,
+                self.linux_line,
+                self.initrd_line,
                 kernel_opts,
                 os.path.join(self.entry_dir, '%s-current' % self.opsys.name))
 
@@ -218,22 +235,48 @@ class Installer():
         self.log.info('NVRAM configured, new values: \n\n%s\n' % nvram_lines)
 
     def copy_cmdline(self, simulate):
-        self.copy_files(
-            '/proc/cmdline',
-            self.os_folder,
-            simulate = simulate
-        )
+        dest = os.path.join(self.os_folder, 'cmdline')
+        if simulate:
+            self.log.info('Simulate copying: /proc/cmdline => %s' % dest)
+            return True
+        try:
+            self.log.debug('Copying: /proc/cmdline => %s' % dest)
+            with open('/proc/cmdline', 'rb') as cmdline_file:
+                self.write_file(dest, cmdline_file.read())
+            return True
+        except Exception as e:
+            self.log.debug(e)
+            raise FileOpsError("Could not copy one or more files.")
+
+    def write_file(self, path, data): # Replace path with data atomically
+        tmp_path = '%s.tmp' % path
+        try:
+            with open(tmp_path, 'wb') as out_obj:
+                out_obj.write(data)
+                out_obj.flush()
+                os.fsync(out_obj.fileno())
+            os.replace(tmp_path, path)
+        except:
+            self.remove_files(tmp_path)
+            raise
 
 
     def make_loader_entry(self, title, linux, initrd, options, filename):
         self.log.info('Making entry file for %s' % title)
-        with open('%s.conf' % filename, mode='w') as entry:
-            entry.write('title %s\n' % title)
-            entry.write('linux %s\n' % linux)
-            entry.write('initrd %s\n' % initrd)
-            entry.write('options %s\n' % options)
+        entry = ('title %s\n' % title +
+                 'linux %s\n' % linux +
+                 'initrd %s\n' % initrd +
+                 'options %s\n' % options)
+        self.write_file('%s.conf' % filename, entry.encode('UTF-8'))
         self.log.debug('Entry created!')
 
+    def remove_files(self, *paths): # Clean up after a failed copy
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
     def ensure_dir(self, directory, simulate=False):
         if not simulate:
             try:
@@ -268,9 +311,59 @@ class Installer():
         else:
             try:
                 self.log.debug('Copying: %s => %s' % (src, dest))
-                shutil.copy(src, dest)
+                if os.path.isdir(dest):
+                    dest = os.path.join(dest, os.path.basename(src))
+                with open(src, 'rb') as in_obj:
+                    with open(dest, 'wb') as out_obj:
+                        self.sendfile(in_obj, out_obj)
+                shutil.copymode(src, dest)
                 return True
             except Exception as e:
                 self.log.debug(e)
                 raise FileOpsError("Could not copy one or more files.")
                 return False
+
+    def sendfile(self, in_obj, out_obj): # Copy in-kernel, no userspace buffer
+        try:
+            # We read the whole image front to back, so ask for more readahead
+            os.posix_fadvise(in_obj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+        size = os.fstat(in_obj.fileno()).st_size
+        blocksize = max(size, 8388608)
+        if size and self.copy_file_range(in_obj, out_obj, blocksize):
+            return
+        offset = 0
+        try:
+            while True:
+                sent = os.sendfile(
+                    out_obj.fileno(), in_obj.fileno(), offset, blocksize)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError:
+            # Some sources (e.g. older procfs) can't be spliced; fall back to
+            # a regular read/write copy if nothing has been written yet.
+            if offset:
+                raise
+            shutil.copyfileobj(in_obj, out_obj)
+
+    def copy_file_range(self, in_obj, out_obj, blocksize):
+        # Lets the filesystem copy (or share) the data itself. Returns False
+        # without writing anything if that isn't possible here, e.g. across
+        # filesystems on older kernels, or on Python < 3.8.
+        if not hasattr(os, 'copy_file_range'):
+            return False
+        copied = 0
+        try:
+            while True:
+                count = os.copy_file_range(
+                    in_obj.fileno(), out_obj.fileno(), blocksize)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            if copied:
+                raise
+            return False
+        return copied > 0
@@ -4,9 +4,12 @@ from debian.changelog import Version
 import os
 import os.path
 
-def options(path):
+def options(path, names=None):
+    # names lets callers that have already listed path pass that in
+    if names is None:
+        names = os.listdir(path)
     items={}
-    for name in os.listdir(path):
+    for name in names:
         key = None
         if name.startswith("vmlinuz-"):
             key = "kernel"
@@ -42,8 +45,8 @@ def get_newest_option(opts):
     
     return latest_option, latest_version
 
-def latest_option(path):
-    opts = options(path)
+def latest_option(path, names=None):
+    opts = options(path, names)
     latest_option, latest_version = get_newest_option(opts)
     
     if latest_version is not None:
@@ -22,7 +22,9 @@ Please see the provided LICENSE.txt file for additional distribution/copyright
 terms.
 """
 
-import subprocess, logging
+import subprocess, logging, re
+
+boot_entry = re.compile(r'Boot([0-9A-Fa-f]{4})\*?\s')
 
 class NVRAM():
 
@@ -42,8 +44,6 @@ class NVRAM():
         self.log.debug('Updating NVRAM info')
         self.nvram = self.get_nvram()
         self.find_os_entry(self.nvram, self.os_label)
-        if self.os_entry_index >= 0:
-            self.order_num = str(self.nvram[self.os_entry_index])[4:8]
 
     def get_nvram(self):
         self.log.debug('Getting NVRAM data')
@@ -60,13 +60,16 @@ class NVRAM():
     def find_os_entry(self, nvram, os_label):
         self.log.debug('Finding NVRAM entry for %s' % os_label)
         self.os_entry_index = -1
-        find_index = self.os_entry_index
-        for entry in nvram:
-            find_index = find_index + 1
-            if os_label in entry:
-                self.os_entry_index = find_index
+        for index, entry in enumerate(nvram):
+            if os_label not in entry:
+                continue
+            match = boot_entry.match(entry)
+            if match:
+                self.os_entry_index = index
+                self.order_num = match.group(1)
                 self.log.debug('Entry found! Index: %s' % self.os_entry_index)
-                return find_index
+                break
+        return self.os_entry_index
 
 
     def add_entry(self, this_os, this_drive, kernel_opts, simulate=False):
@@ -22,7 +22,16 @@ Please see the provided LICENSE.txt file for additional distribution/copyright
 terms.
 """
 
-import platform
+import copy, functools, platform
+
+@functools.lru_cache(maxsize=1)
+def detect_os():
+    return OS()
+
+def get_os():
+    # The OS identity can't change while we're running, so only detect it once.
+    # Hand out a copy, since callers fill in the kernel/initrd paths.
+    return copy.copy(detect_os())
 
 class OS():
 
@@ -34,13 +43,13 @@ class OS():
     initrd_name = 'initrd.img'
     old_kernel_name = 'vmlinuz.old'
     old_initrd_name = 'initrd.img.old'
-    kernel_release = platform.release()
     kernel_path = '/vmlinuz'
     initrd_path = '/initrd.img'
     old_kernel_path = '/vmlinuz.old'
     old_initrd_path = '/initrd.img.old'
 
     def __init__(self):
+        self.os_release = self.get_os_release()
         self.name_pretty = self.get_os_name()
         self.name = self.clean_names(self.name_pretty)
         self.version = self.get_os_version()
@@ -93,46 +102,33 @@ class OS():
 
     def get_os_cmdline(self):
         with open('/proc/cmdline') as cmdline_file:
-            cmdline_list = cmdline_file.readlines()[0].split(" ")
+            cmdline_list = cmdline_file.read().split()
 
-        cmdline = []
-        for option in cmdline_list:
-            if not option.startswith('BOOT_IMAGE'):
-                if not option.startswith('root='):
-                    if not option.startswith('initrd='):
-                        cmdline.append(option)
-        return cmdline
+        skip = ('BOOT_IMAGE', 'root=', 'initrd=')
+        return [option for option in cmdline_list if not option.startswith(skip)]
 
     def get_os_name(self):
-        os_release = self.get_os_release()
-        for item in os_release:
-            if item.startswith('NAME='):
-                name = item.split('=')[1]
-                return self.strip_quotes(name[:-1])
+        return self.os_release.get('NAME', self.name)
 
     def get_os_version(self):
-        os_release = self.get_os_release()
-        for item in os_release:
-            if item.startswith('VERSION_ID='):
-                version =  item.split('=')[1]
-                return self.strip_quotes(version[:-1])
-
-    def strip_quotes(self, value):
-        new_value = value
-        if value.startswith('"'):
-            new_value = new_value[1:]
-        if value.endswith('"'):
-            new_value = new_value[:-1]
-        return new_value
+        return self.os_release.get('VERSION_ID', self.version)
 
     def get_os_release(self):
         try:
-            with open('/etc/os-release') as os_release_file:
-                os_release = os_release_file.readlines()
-        except FileNotFoundError:
-            os_release = ['NAME="%s"\n' % self.name,
-                          'ID=linux\n',
-                          'ID_LIKE=linux\n',
-                          'VERSION_ID="%s"\n' % self.version]
-
+            if hasattr(platform, 'freedesktop_os_release'):
+                return platform.freedesktop_os_release()
+            return self.parse_os_release()
+        except OSError:
+            return {'NAME': self.name,
+                    'ID': 'linux',
+                    'ID_LIKE': 'linux',
+                    'VERSION_ID': self.version}
+
+    def parse_os_release(self): # Fallback for Python < 3.10
+        os_release = {}
+        with open('/etc/os-release') as os_release_file:
+            for line in os_release_file:
+                if '=' in line:
+                    key, value = line.rstrip().split('=', 1)
+                    os_release[key] = value.strip('"')
         return os_release